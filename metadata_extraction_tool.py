@@ -1,20 +1,105 @@
 import requests
+from requests.adapters import HTTPAdapter
+import httpx
+import asyncio
 import os
 import io
-import base64
 import csv
+import contextlib
+import hashlib
+import json
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from PIL import Image
 from google.cloud import vision
 from dotenv import load_dotenv
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+# Optional accelerated image libraries; without them we fall back to Pillow.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _TJ = TurboJPEG()
+except (ImportError, OSError, RuntimeError): # RuntimeError: turbojpeg shared library not found
+    _TJ = None
+
+try:
+    import cv2 # SIMD-accelerated INTER_AREA downscaling
+except ImportError:
+    cv2 = None
+
+try:
+    import imagesize # Pure-Python header parser, much cheaper than Image.open for a size check
+except ImportError:
+    imagesize = None
+
+try:
+    from pybase64 import b64encode # SIMD-accelerated base64
+except ImportError:
+    from base64 import b64encode
+
+try:
+    from orjson import loads as json_loads # Faster parsing of Astica responses
+except ImportError:
+    from json import loads as json_loads
 
 # Load environment variables from .env file if it exists
 load_dotenv()
 
 # --- Configuration Constants ---
 OUTPUT_CSV_FILENAME = "image_metadata.csv"
+VERBOSE = os.environ.get('IMAGE_METADATA_VERBOSE', '').lower() in ('1', 'true', 'yes') # Per-image size logging
+CSV_FIELDNAMES = ["Filename", "Description", "Tags"]
+METADATA_CACHE_FILENAME = "metadata_cache.json"
+_IMG_EXTS = frozenset({'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff'})
 MAX_IMAGE_WIDTH = 1024
 COMPRESSION_QUALITY = 85
+PASSTHROUGH_MAX_BYTES = 1024 * 1024 # JPEGs within MAX_IMAGE_WIDTH and up to this size are sent unmodified
+PROCESS_POOL_MIN_IMAGES = 8 # Below this, process startup costs more than it saves
 ASTICA_API_TIMEOUT = 30 # seconds
+VISION_BATCH_SIZE = 16 # Max images per Vision batch_annotate_images request
+VISION_BATCH_MAX_BYTES = 8 * 1024 * 1024 # Image bytes per Vision batch, kept under the API's per-request size limit
+VISION_MAX_WORKERS = 16 # Vision batch requests in flight at once
+VISION_TAGS_FAILED = "Google Vision tags failed" # Tags value for images Vision could not label
+VISION_BATCH_LINGER = 0.05 # seconds to wait for a Vision batch to fill before sending it
+ASTICA_API_ENDPOINT = 'https://vision.astica.ai/describe'
+ASTICA_MAX_CONCURRENCY = 10 # Concurrent Astica requests, to respect Astica rate limits
+ASTICA_MAX_CONNECTIONS = 20
+ASTICA_MAX_ATTEMPTS = 5 # Attempts per image when Astica is rate limiting or overloaded
+ASTICA_RETRY_STATUS_CODES = (429, 503)
+ASTICA_MAX_RETRY_AFTER = 60 # seconds; upper bound on how long we honour a Retry-After header
+ASTICA_HEADERS = {'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'}
+PIPELINE_QUEUE_SIZE = 64 # Max compressed images buffered between pipeline stages
+
+# --- Shared API Clients ---
+# A single pooled session keeps TCP/TLS connections to Astica alive between images.
+_ASTICA_SESSION = requests.Session()
+_ASTICA_SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+_ASTICA_SESSION.headers.update(ASTICA_HEADERS)
+
+_vision_client = None
+_vision_client_lock = threading.Lock()
+
+def _get_vision_client():
+    """
+    Returns a process-wide Google Vision client, creating it on first use.
+    Created lazily because credentials are only configured once main() has run.
+    """
+    global _vision_client
+    if _vision_client is None:
+        with _vision_client_lock:
+            if _vision_client is None:
+                _vision_client = vision.ImageAnnotatorClient()
+    return _vision_client
 
 # --- Helper to check if running in Colab ---
 def is_running_in_colab():
@@ -62,87 +147,284 @@ def setup_google_credentials():
     return False # Default case
 
 # --- Image Processing Functions ---
-def compress_image(image_path, max_width=MAX_IMAGE_WIDTH, quality=COMPRESSION_QUALITY):
-    """Compresses and resizes an image in-place."""
-    try:
-        img = Image.open(image_path)
-        original_size = os.path.getsize(image_path)
+def find_images(root):
+    """Recursively finds image files under `root` in a single directory walk."""
+    image_paths = []
+    for dirpath, _, filenames in os.walk(root):
+        image_paths.extend(
+            os.path.join(dirpath, f_name) for f_name in filenames
+            if os.path.splitext(f_name)[1].lower() in _IMG_EXTS
+        )
+    return sorted(image_paths)
+
+def _resize_pixels(pixels, max_width):
+    """
+    Downscales an image array to `max_width`, preserving the aspect ratio.
+    Uses OpenCV's INTER_AREA when available, otherwise Pillow's LANCZOS.
+    """
+    height, width = pixels.shape[:2]
+    if width <= max_width:
+        return pixels
+
+    height_size = int(height * (max_width / float(width)))
+    if cv2 is not None:
+        return cv2.resize(pixels, (max_width, height_size), interpolation=cv2.INTER_AREA)
+    return np.asarray(Image.fromarray(pixels).resize((max_width, height_size), Image.LANCZOS))
+
+def _compress_with_pillow(image_path, max_width, quality):
+    """Resizes and JPEG-encodes an image using Pillow."""
+    img = Image.open(image_path)
 
-        if img.width > max_width:
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB') # JPEG has no alpha channel or palette
+
+    if img.width > max_width:
+        if cv2 is not None:
+            img = Image.fromarray(_resize_pixels(np.asarray(img), max_width))
+        else:
             width_percent = (max_width / float(img.width))
             height_size = int((float(img.height) * float(width_percent)))
             img = img.resize((max_width, height_size), Image.LANCZOS) # LANCZOS is good for downscaling
 
-        img.save(image_path, quality=quality, optimize=True)
-        compressed_size = os.path.getsize(image_path)
-        print(f"Compressed {os.path.basename(image_path)}: {original_size} bytes -> {compressed_size} bytes")
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=quality, optimize=True)
+    return buf.getvalue()
+
+def _compress_with_turbojpeg(image_path, max_width, quality):
+    """Resizes and JPEG-encodes an image using libjpeg-turbo's SIMD codec."""
+    if os.path.splitext(image_path)[1].lower() in ('.jpg', '.jpeg'):
+        with open(image_path, 'rb') as image_file:
+            pixels = _TJ.decode(image_file.read(), pixel_format=TJPF_RGB)
+    else: # libjpeg-turbo only decodes JPEG
+        with Image.open(image_path) as img:
+            pixels = np.asarray(img.convert('RGB'))
+
+    pixels = _resize_pixels(pixels, max_width)
+    return _TJ.encode(np.ascontiguousarray(pixels), quality=quality, pixel_format=TJPF_RGB)
+
+def _is_small_jpeg(image_path, max_width):
+    """
+    Checks whether an image is a JPEG already within `max_width`, reading only its header.
+    Uses imagesize when available so PIL is not involved at all; otherwise falls back to Image.open.
+    """
+    if imagesize is not None:
+        if os.path.splitext(image_path)[1].lower() not in ('.jpg', '.jpeg'):
+            return False
+        width, _ = imagesize.get(image_path)
+        if width >= 0: # -1 means imagesize could not parse the header
+            return width <= max_width
+
+    with Image.open(image_path) as img: # Only reads the header
+        return img.format == 'JPEG' and img.mode in ('RGB', 'L') and img.width <= max_width
+
+def compress_image_to_bytes(image_path, max_width=MAX_IMAGE_WIDTH, quality=COMPRESSION_QUALITY, name=None, verbose=False):
+    """
+    Resizes and JPEG-compresses an image in memory and returns the compressed bytes.
+    Small JPEGs that are already within `max_width` are returned as-is, avoiding a
+    decode/encode cycle and JPEG generation loss.
+    `name` is the display name used in log messages; sizes are only logged when `verbose`.
+    The original file on disk is left untouched. Returns None if the image cannot be read.
+    """
+    if name is None:
+        name = os.path.basename(image_path)
+    try:
+        if _is_small_jpeg(image_path, max_width):
+            with open(image_path, 'rb') as image_file:
+                content = image_file.read()
+            if len(content) <= PASSTHROUGH_MAX_BYTES:
+                if verbose:
+                    print(f"Skipped resize for {name}: already within {max_width}px ({len(content)} bytes)")
+                return content
+
+        if _TJ is not None:
+            content = _compress_with_turbojpeg(image_path, max_width, quality)
+        else:
+            content = _compress_with_pillow(image_path, max_width, quality)
+        if verbose:
+            print(f"Compressed {name}: {os.path.getsize(image_path)} bytes -> {len(content)} bytes")
+        return content
     except FileNotFoundError:
         print(f"Error: Image file not found at {image_path} for compression.")
+        return None
     except Exception as e:
-        print(f"Error compressing image {os.path.basename(image_path)}: {e}")
+        print(f"Error compressing image {name}: {e}")
+        return None
 
-def get_image_tags_from_google(image_path):
-    """Detects labels from Google Cloud Vision."""
+def _compression_executor(num_images):
+    """
+    Returns an executor for compressing `num_images` images in parallel across CPU cores.
+    Small batches use threads instead, to avoid process startup cost.
+    Worker processes are spawned rather than forked: the pipeline has live gRPC threads
+    (Google Vision client) by the time workers start, and forking those can hang.
+    """
+    if num_images >= PROCESS_POOL_MIN_IMAGES:
+        return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+    return ThreadPoolExecutor()
+
+def get_image_tags_from_google(content, name="image"):
+    """Detects labels from Google Cloud Vision for in-memory image bytes. `name` is used in log messages."""
     try:
-        client = vision.ImageAnnotatorClient() # Initialize client after credentials are confirmed
-        with io.open(image_path, 'rb') as image_file:
-            content = image_file.read()
+        client = _get_vision_client()
         image_vision = vision.Image(content=content) # Renamed to avoid conflict with PIL.Image
         response = client.label_detection(image=image_vision)
+        return _tags_from_vision_response(response)
+    except Exception as e:
+        print(f"Error getting tags from Google Vision for {name}: {e}")
+        return VISION_TAGS_FAILED
+
+def _tags_from_vision_response(response):
+    """Turns a Vision AnnotateImageResponse into a comma-separated tag string."""
+    if response.error.message:
+        raise Exception(f"Google Vision API error: {response.error.message}")
+
+    labels = response.label_annotations
+    google_tags = ", ".join([label.description for label in labels])
+    return google_tags if google_tags else "No tags found by Google Vision"
+
+def _batch_annotate_requests(images):
+    """Builds label-detection AnnotateImageRequests for a list of (image_path, content) pairs."""
+    label_feature = vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION)
+    return [vision.AnnotateImageRequest(image=vision.Image(content=content), features=[label_feature]) for _, content in images]
+
+def _tags_from_batch_response(image_paths, batch_response):
+    """Maps a BatchAnnotateImagesResponse back to {image_path: tags}."""
+    tags_by_path = {}
+    # Responses come back in the same order as the requests
+    for image_path, response in zip(image_paths, batch_response.responses):
+        try:
+            tags_by_path[image_path] = _tags_from_vision_response(response)
+        except Exception as e:
+            print(f"Error getting tags from Google Vision for {os.path.basename(image_path)}: {e}")
+            tags_by_path[image_path] = VISION_TAGS_FAILED
+    return tags_by_path
 
-        if response.error.message:
-            raise Exception(f"Google Vision API error: {response.error.message}")
+def _annotate_chunk(client, images):
+    """
+    Runs one batch_annotate_images call for up to VISION_BATCH_SIZE images.
+    `images` is a list of (image_path, content) pairs. Returns {image_path: tags}.
+    """
+    image_paths = [image_path for image_path, _ in images]
+    if not image_paths:
+        return {}
 
-        labels = response.label_annotations
-        google_tags = ", ".join([label.description for label in labels])
-        return google_tags if google_tags else "No tags found by Google Vision"
+    try:
+        batch_response = client.batch_annotate_images(requests=_batch_annotate_requests(images))
     except Exception as e:
-        print(f"Error getting tags from Google Vision for {os.path.basename(image_path)}: {e}")
-        return "Google Vision tags failed"
+        print(f"Error in Google Vision batch request: {e}")
+        return {image_path: VISION_TAGS_FAILED for image_path in image_paths}
+
+    return _tags_from_batch_response(image_paths, batch_response)
+
+async def _annotate_chunk_async(client, images):
+    """Async variant of _annotate_chunk for an ImageAnnotatorAsyncClient."""
+    image_paths = [image_path for image_path, _ in images]
+    if not image_paths:
+        return {}
 
-def convert_image_to_base64(image_path):
-    """Convert a local image to a base64 string."""
     try:
-        with open(image_path, 'rb') as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-        return base64_image
-    except FileNotFoundError:
-        print(f"Error: Image file not found at {image_path} for base64 conversion.")
-        return None
+        batch_response = await client.batch_annotate_images(requests=_batch_annotate_requests(images))
     except Exception as e:
-        print(f"Error converting image {os.path.basename(image_path)} to base64: {e}")
-        return None
+        print(f"Error in Google Vision batch request: {e}")
+        return {image_path: VISION_TAGS_FAILED for image_path in image_paths}
 
-def get_description_from_astica(image_base64):
-    """Uses Astica AI to get a description for a base64-encoded image."""
-    astica_api_key = os.environ.get('ASTICA_API_KEY')
-    if not astica_api_key:
-        print("Error: ASTICA_API_KEY environment variable not set.")
-        return "Astica API key not configured"
+    return _tags_from_batch_response(image_paths, batch_response)
+
+def to_base64(content):
+    """Convert in-memory image bytes to a base64 string (base64 output is pure ASCII)."""
+    return b64encode(content).decode('ascii')
 
-    api_endpoint = 'https://vision.astica.ai/describe'
-    params = {
+def _astica_params(astica_api_key, image_base64):
+    """Builds the Astica /describe request payload."""
+    return {
         'tkn': astica_api_key,
         'modelVersion': '1.0_full', # Consider making this configurable
         'input': image_base64,
         'visionParams': 'describe'
     }
 
+def _description_from_astica_result(astica_result):
+    """
+    Extracts the caption (or an error message) from a parsed Astica response.
+    Returns (ok, description), where ok is False if Astica reported an error.
+    """
+    if astica_result.get('status') == 'error' or 'error' in astica_result:
+        error_msg = astica_result.get('error', 'Unknown Astica API error')
+        print(f"Astica API returned an error: {error_msg}")
+        return False, f"Astica API error: {error_msg}"
+
+    astica_description = astica_result.get('caption', '').strip()
+    return True, astica_description if astica_description else "No description available from Astica"
+
+def _is_retryable_astica_error(exc):
+    """True for HTTP 429/503 responses, which mean Astica wants us to back off and try again."""
+    if not isinstance(exc, (requests.exceptions.HTTPError, httpx.HTTPStatusError)):
+        return False
+    return exc.response is not None and exc.response.status_code in ASTICA_RETRY_STATUS_CODES
+
+def _retry_after_seconds(response):
+    """Parses a Retry-After header (delay in seconds or an HTTP date). Returns None if absent or invalid."""
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
     try:
-        response_astica = requests.post(api_endpoint, json=params, timeout=ASTICA_API_TIMEOUT)
-        response_astica.raise_for_status() # Raises HTTPError for bad responses (4XX or 5XX)
-        astica_result = response_astica.json()
+        delay = float(value)
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+    return min(max(delay, 0.0), ASTICA_MAX_RETRY_AFTER)
+
+# Jittered, so concurrent workers that were rate limited together don't all retry in lockstep
+_astica_backoff = wait_random_exponential(multiplier=1, max=10)
+
+def _astica_wait(retry_state):
+    """Waits as long as Astica's Retry-After header asks, falling back to jittered exponential backoff."""
+    exc = retry_state.outcome.exception()
+    retry_after = _retry_after_seconds(getattr(exc, 'response', None))
+    return retry_after if retry_after is not None else _astica_backoff(retry_state)
+
+_astica_retry = retry(
+    retry=retry_if_exception(_is_retryable_astica_error),
+    wait=_astica_wait,
+    stop=stop_after_attempt(ASTICA_MAX_ATTEMPTS),
+    reraise=True, # Surface the final HTTP error to the caller's handlers
+)
+
+@_astica_retry
+def _post_astica(params):
+    """POSTs to Astica over the pooled session, retrying with backoff on 429/503."""
+    response_astica = _ASTICA_SESSION.post(ASTICA_API_ENDPOINT, json=params, timeout=ASTICA_API_TIMEOUT)
+    response_astica.raise_for_status() # Raises HTTPError for bad responses (4XX or 5XX)
+    return response_astica
+
+@_astica_retry
+async def _post_astica_async(client, params):
+    """Async variant of _post_astica."""
+    response_astica = await client.post(ASTICA_API_ENDPOINT, json=params, timeout=ASTICA_API_TIMEOUT)
+    response_astica.raise_for_status()
+    return response_astica
 
-        if astica_result.get('status') == 'error' or 'error' in astica_result:
-            error_msg = astica_result.get('error', 'Unknown Astica API error')
-            print(f"Astica API returned an error: {error_msg}")
-            return f"Astica API error: {error_msg}"
+def get_description_from_astica(image_base64):
+    """Uses Astica AI to get a description for a base64-encoded image."""
+    astica_api_key = os.environ.get('ASTICA_API_KEY')
+    if not astica_api_key:
+        print("Error: ASTICA_API_KEY environment variable not set.")
+        return "Astica API key not configured"
 
-        astica_description = astica_result.get('caption', '').strip()
-        return astica_description if astica_description else "No description available from Astica"
+    params = _astica_params(astica_api_key, image_base64)
+
+    try:
+        response_astica = _post_astica(params)
+        astica_result = json_loads(response_astica.content)
+        _, astica_description = _description_from_astica_result(astica_result)
+        return astica_description
 
     except requests.exceptions.HTTPError as http_err:
-        print(f"Astica API HTTP error: {http_err} - Response: {response_astica.text if 'response_astica' in locals() else 'No response object'}")
+        print(f"Astica API HTTP error: {http_err} - Response: {http_err.response.text if http_err.response is not None else 'No response object'}")
         return "Astica API request failed (HTTP error)"
     except requests.exceptions.RequestException as req_err: # Catches DNS errors, connection timeouts, etc.
         print(f"Astica API request error: {req_err}")
@@ -154,23 +436,321 @@ def get_description_from_astica(image_base64):
         print(f"An unexpected error occurred with Astica API: {e}")
         return "Astica description processing failed (Unexpected error)"
 
+async def get_description_from_astica_async(client, image_base64):
+    """
+    Async variant of get_description_from_astica using a shared httpx.AsyncClient.
+    Returns (ok, description); on failure ok is False and description is an error message.
+    """
+    astica_api_key = os.environ.get('ASTICA_API_KEY')
+    if not astica_api_key:
+        print("Error: ASTICA_API_KEY environment variable not set.")
+        return False, "Astica API key not configured"
+
+    params = _astica_params(astica_api_key, image_base64)
+
+    try:
+        response_astica = await _post_astica_async(client, params)
+        astica_result = json_loads(response_astica.content)
+        return _description_from_astica_result(astica_result)
+
+    except httpx.HTTPStatusError as http_err:
+        print(f"Astica API HTTP error: {http_err} - Response: {http_err.response.text}")
+        return False, "Astica API request failed (HTTP error)"
+    except httpx.RequestError as req_err: # Catches DNS errors, connection timeouts, etc.
+        print(f"Astica API request error: {req_err}")
+        return False, "Astica API request failed (Connection/Request error)"
+    except ValueError as json_err: # Catches JSONDecodeError
+        print(f"Error decoding Astica API JSON response: {json_err}")
+        return False, "Astica API response JSON decoding failed"
+    except Exception as e:
+        print(f"An unexpected error occurred with Astica API: {e}")
+        return False, "Astica description processing failed (Unexpected error)"
+
+# --- Metadata Cache ---
+def _source_hash(image_path, max_width=MAX_IMAGE_WIDTH, quality=COMPRESSION_QUALITY):
+    """
+    Cache key for an image: SHA-256 of the source file plus the compression settings.
+    Hashing the source rather than the compressed output keeps keys stable whichever
+    encoder (libjpeg-turbo, OpenCV, Pillow) is installed, and lets cache hits skip compression.
+    """
+    digest = hashlib.sha256(f"{max_width}:{quality}:".encode('ascii'))
+    with open(image_path, 'rb') as image_file:
+        for block in iter(lambda: image_file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_metadata_cache(cache_path=METADATA_CACHE_FILENAME):
+    """Loads the {source hash (see _source_hash): {'tags', 'description'}} cache from previous runs."""
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as cache_file:
+            cache = json.load(cache_file)
+        print(f"Loaded {len(cache)} cached result(s) from {cache_path}")
+        return cache
+    except (IOError, ValueError) as e:
+        print(f"Warning: could not read metadata cache '{cache_path}', starting with an empty cache: {e}")
+        return {}
+
+def save_metadata_cache(cache, cache_path=METADATA_CACHE_FILENAME):
+    """Writes the metadata cache to disk, replacing the previous file atomically."""
+    tmp_path = cache_path + ".tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(tmp_path, cache_path)
+    except IOError as e:
+        print(f"Error writing metadata cache '{cache_path}': {e}")
+
+def _is_cacheable(google_tags, astica_ok):
+    """Only successful API results are cached, so failures are retried on the next run."""
+    return astica_ok and google_tags != VISION_TAGS_FAILED
+
 # --- Main Processing Logic ---
-def process_image_metadata(image_path):
-    """Generates metadata for a single image."""
+def _compression_failed_metadata(filename):
+    """Metadata row for an image that could not be read or compressed, so it still shows up in the CSV."""
+    return {
+        'filename': filename,
+        'description': "Astica processing skipped (image could not be compressed)",
+        'tags': "Google Vision processing skipped (image could not be compressed)"
+    }
+
+async def run_pipeline(image_paths, on_result, cache=None, verbose=False, root=None):
+    """
+    Processes images as a three-stage pipeline: compress -> Google Vision -> Astica.
+    The stages have different bottlenecks (CPU, gRPC, HTTP), so while one image is at Astica
+    the next can be at Google Vision and the one after that compressing.
+    Stages are linked by asyncio.Queues and shut down with a None sentinel per worker.
+    `on_result(metadata)` is called for each finished image. Returns the number of images processed.
+    If a `cache` dict is given, images whose source hash is cached skip compression and both APIs,
+    and new successful results are added to it. Duplicate images within a run are processed once;
+    later copies wait for the first copy's result. `verbose` enables per-image size logging.
+    If `root` is given, filenames are reported relative to it, so images with the same name in
+    different subdirectories stay distinguishable; otherwise the base name is used.
+    """
+    if cache is None:
+        cache = {}
+    loop = asyncio.get_running_loop()
+    path_queue = asyncio.Queue()
+    vision_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    astica_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    result_queue = asyncio.Queue()
+
+    num_compress_workers = os.cpu_count() or 1
+    num_vision_workers = 1
+    num_astica_workers = ASTICA_MAX_CONCURRENCY # Bounds concurrent Astica requests
+
+    # Prefer the native gRPC-asyncio client; fall back to the sync client on a thread pool
+    vision_async_client = None
+    vision_client = None
+    try:
+        vision_async_client = vision.ImageAnnotatorAsyncClient()
+    except Exception as e:
+        print(f"Google Vision async client unavailable, falling back to the sync client: {e}")
+        try:
+            vision_client = _get_vision_client()
+        except Exception as e:
+            print(f"Error creating Google Vision client: {e}")
+
+    # {source hash: Future resolving to the first copy's metadata}, only while that copy is in progress
+    in_flight = {}
+    duplicate_tasks = set() # Pending only; finished tasks remove themselves
+
+    async def finish(content_hash, metadata):
+        # Waiting duplicates already hold the Future; later copies are served by `cache` on success
+        in_flight.pop(content_hash).set_result(metadata)
+        await result_queue.put(metadata)
+
+    async def emit_duplicate(name, first_copy):
+        metadata = await first_copy
+        await result_queue.put({
+            'filename': name,
+            'description': metadata['description'],
+            'tags': metadata['tags']
+        })
+
+    process_pool_broken = False
+
+    async def compress(executor, fallback_executor, image_path, name):
+        # Spawned workers re-import this module by path, which fails when the code lives in a
+        # notebook's __main__; in that case compress on threads rather than abort the pipeline
+        nonlocal process_pool_broken
+        job = partial(compress_image_to_bytes, image_path, name=name, verbose=verbose)
+        if not process_pool_broken:
+            try:
+                return await loop.run_in_executor(executor, job)
+            except BrokenProcessPool as e:
+                if not process_pool_broken:
+                    print(f"Compression worker processes failed ({e}); compressing on threads instead.")
+                process_pool_broken = True
+        return await loop.run_in_executor(fallback_executor, job)
+
+    async def compress_worker(executor, fallback_executor):
+        while True:
+            image_path = await path_queue.get()
+            if image_path is None:
+                return
+            # Computed once and carried through the pipeline
+            name = os.path.relpath(image_path, root) if root else os.path.basename(image_path)
+            try:
+                content_hash = await loop.run_in_executor(None, _source_hash, image_path)
+            except OSError as e:
+                print(f"Skipping {name}: image could not be read: {e}")
+                await result_queue.put(_compression_failed_metadata(name))
+                continue
+
+            cached = cache.get(content_hash)
+            if cached is not None:
+                print(f"Using cached metadata for {name}.")
+                await result_queue.put({
+                    'filename': name,
+                    'description': cached['description'],
+                    'tags': cached['tags']
+                })
+                continue
+            if content_hash in in_flight:
+                print(f"{name} is a duplicate of an image already being processed; reusing its result.")
+                task = asyncio.ensure_future(emit_duplicate(name, in_flight[content_hash]))
+                duplicate_tasks.add(task)
+                task.add_done_callback(duplicate_tasks.discard)
+                continue
+            in_flight[content_hash] = loop.create_future()
+
+            content = await compress(executor, fallback_executor, image_path, name)
+            if content is None:
+                print(f"Skipping {name}: image could not be compressed.")
+                await finish(content_hash, _compression_failed_metadata(name))
+                continue
+            await vision_queue.put((image_path, name, content, content_hash))
+
+    async def annotate_batch(executor, batch, batch_slots):
+        try:
+            images = [(image_path, content) for image_path, _, content, _ in batch]
+            if vision_async_client is not None:
+                tags_by_path = await _annotate_chunk_async(vision_async_client, images)
+            elif vision_client is not None:
+                tags_by_path = await loop.run_in_executor(executor, _annotate_chunk, vision_client, images)
+            else:
+                tags_by_path = {}
+        finally:
+            batch_slots.release()
+        for image_path, name, content, content_hash in batch:
+            await astica_queue.put((name, content, content_hash, tags_by_path.get(image_path, VISION_TAGS_FAILED)))
+
+    async def google_dispatcher(executor):
+        # A single dispatcher groups images into batches; up to VISION_MAX_WORKERS batches run at once.
+        # Batches are capped by image count and by total bytes, to stay under Vision's request size limit.
+        batch_slots = asyncio.Semaphore(VISION_MAX_WORKERS)
+        batch_tasks = []
+        carry = None # Item that would have overflowed the previous batch
+        done = False
+        while not done:
+            if carry is not None:
+                item, carry = carry, None
+            else:
+                item = await vision_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            batch_bytes = len(item[2])
+            if vision_queue.qsize() < VISION_BATCH_SIZE - 1:
+                await asyncio.sleep(VISION_BATCH_LINGER) # Give the batch a moment to fill up
+            while len(batch) < VISION_BATCH_SIZE and not vision_queue.empty():
+                item = vision_queue.get_nowait()
+                if item is None:
+                    done = True
+                    break
+                if batch_bytes + len(item[2]) > VISION_BATCH_MAX_BYTES:
+                    carry = item
+                    break
+                batch.append(item)
+                batch_bytes += len(item[2])
+
+            await batch_slots.acquire()
+            batch_tasks.append(asyncio.ensure_future(annotate_batch(executor, batch, batch_slots)))
+        await asyncio.gather(*batch_tasks)
+
+    async def astica_worker(client):
+        while True:
+            item = await astica_queue.get()
+            if item is None:
+                return
+            name, content, content_hash, google_tags = item
+            astica_ok, description = await get_description_from_astica_async(client, to_base64(content))
+            if _is_cacheable(google_tags, astica_ok):
+                cache[content_hash] = {'tags': google_tags, 'description': description}
+            await finish(content_hash, {
+                'filename': name,
+                'description': description,
+                'tags': google_tags
+            })
+
+    async def result_writer():
+        count = 0
+        while True:
+            metadata = await result_queue.get()
+            if metadata is None:
+                return count
+            on_result(metadata)
+            count += 1
+
+    async def run_stage(workers, next_queue, num_next_workers):
+        await asyncio.gather(*workers)
+        for _ in range(num_next_workers):
+            await next_queue.put(None)
+
+    async def run_final_stage(workers):
+        await asyncio.gather(*workers)
+        await asyncio.gather(*list(duplicate_tasks)) # All created by now: compression finished before Astica did
+        await result_queue.put(None)
+
+    for image_path in image_paths:
+        path_queue.put_nowait(image_path)
+    for _ in range(num_compress_workers):
+        path_queue.put_nowait(None)
+
+    limits = httpx.Limits(max_connections=ASTICA_MAX_CONNECTIONS)
+    try:
+        with contextlib.ExitStack() as stack:
+            compress_executor = stack.enter_context(_compression_executor(len(image_paths)))
+            fallback_executor = stack.enter_context(ThreadPoolExecutor()) # Threads are only started if used
+            vision_executor = stack.enter_context(ThreadPoolExecutor(max_workers=VISION_MAX_WORKERS))
+            async with httpx.AsyncClient(limits=limits, headers=ASTICA_HEADERS) as astica_client:
+                results = await asyncio.gather(
+                    run_stage([compress_worker(compress_executor, fallback_executor) for _ in range(num_compress_workers)], vision_queue, num_vision_workers),
+                    run_stage([google_dispatcher(vision_executor) for _ in range(num_vision_workers)], astica_queue, num_astica_workers),
+                    run_final_stage([astica_worker(astica_client) for _ in range(num_astica_workers)]),
+                    result_writer(),
+                )
+    finally:
+        if vision_async_client is not None:
+            await vision_async_client.transport.close()
+    return results[-1]
+
+def _run_coroutine(coro):
+    """
+    Runs a coroutine to completion from synchronous code.
+    In a notebook kernel (e.g. Colab) an event loop is already running and asyncio.run()
+    would raise, so the coroutine is run on a helper thread with its own loop instead.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError: # No running loop: the normal script case
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+def process_image_metadata(image_path, verbose=False):
+    """Generates metadata for a single image. `verbose` enables size logging during compression."""
     filename = os.path.basename(image_path)
     print(f"\nProcessing image: {filename}...")
 
-    compress_image(image_path) # Compresses in-place
-
-    google_tags = get_image_tags_from_google(image_path)
-
-    astica_description = "Astica processing skipped (image not available for base64)"
-    image_base64 = convert_image_to_base64(image_path)
-    if image_base64:
-        astica_description = get_description_from_astica(image_base64)
-    else:
-        print(f"Skipping Astica for {filename} due to base64 conversion failure.")
+    content = compress_image_to_bytes(image_path, name=filename, verbose=verbose)
+    if content is None:
+        return _compression_failed_metadata(filename)
 
+    google_tags = get_image_tags_from_google(content, name=filename)
+    astica_description = get_description_from_astica(to_base64(content))
 
     metadata = {
         'filename': filename,
@@ -193,8 +773,8 @@ def main():
         print("Warning: ASTICA_API_KEY environment variable not set. Descriptions from Astica will not be generated.")
         # Script can continue, but Astica part will yield errors/skipped messages.
 
-    processed_images_metadata = []
     temp_image_paths_colab = [] # To store paths of files temporarily saved in Colab
+    image_root = None # Directory that CSV filenames are reported relative to
 
     if is_running_in_colab():
         from google.colab import files
@@ -225,12 +805,11 @@ def main():
         
         image_paths_to_process = []
         if os.path.isdir(image_source_path):
-            print(f"Scanning directory: {image_source_path}")
-            for f_name in os.listdir(image_source_path):
-                if f_name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff')):
-                    image_paths_to_process.append(os.path.join(image_source_path, f_name))
+            print(f"Scanning directory (including subdirectories): {image_source_path}")
+            image_paths_to_process = find_images(image_source_path)
+            image_root = image_source_path
         elif os.path.isfile(image_source_path):
-            if image_source_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff')):
+            if os.path.splitext(image_source_path)[1].lower() in _IMG_EXTS:
                 image_paths_to_process.append(image_source_path)
             else:
                 print(f"Error: '{image_source_path}' is not a recognized image file type.")
@@ -243,34 +822,39 @@ def main():
             print(f"No compatible image files found at '{image_source_path}'.")
             return
 
-    # Process all identified images
-    for image_path in image_paths_to_process:
-        metadata = process_image_metadata(image_path)
-        processed_images_metadata.append(metadata)
-        print(f"Finished processing {metadata['filename']}.")
-        print(f"  Description: {metadata['description']}")
-        print(f"  Tags: {metadata['tags']}")
-
-    # Write to CSV
-    if processed_images_metadata:
-        try:
-            with open(OUTPUT_CSV_FILENAME, "w", newline='', encoding='utf-8') as csvfile:
-                fieldnames = ["Filename", "Description", "Tags"]
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(processed_images_metadata) # Use writerows for list of dicts
-            print(f"\nMetadata successfully saved to {OUTPUT_CSV_FILENAME}")
+    # Rows are written and flushed as each image finishes, so a crash keeps everything done so far
+    try:
+        with contextlib.ExitStack() as stack:
+            csvfile = stack.enter_context(open(OUTPUT_CSV_FILENAME, "w", newline='', encoding='utf-8'))
+            writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDNAMES)
+            writer.writeheader()
+
+            def write_row(metadata):
+                writer.writerow({'Filename': metadata['filename'], 'Description': metadata['description'], 'Tags': metadata['tags']})
+                csvfile.flush()
+                print(f"Finished processing {metadata['filename']}.")
+                print(f"  Description: {metadata['description']}")
+                print(f"  Tags: {metadata['tags']}")
+
+            metadata_cache = load_metadata_cache()
+            print(f"\nProcessing {len(image_paths_to_process)} image(s)...")
+            try:
+                rows_written = _run_coroutine(run_pipeline(image_paths_to_process, write_row, metadata_cache, verbose=VERBOSE, root=image_root))
+            finally:
+                save_metadata_cache(metadata_cache) # Keep results from partial runs too
 
+        if rows_written:
+            print(f"\nMetadata for {rows_written} image(s) successfully saved to {OUTPUT_CSV_FILENAME}")
             if is_running_in_colab():
                 from google.colab import files
                 print("Attempting to download CSV in Colab...")
                 files.download(OUTPUT_CSV_FILENAME)
-        except IOError as e:
-            print(f"Error writing CSV file '{OUTPUT_CSV_FILENAME}': {e}")
-        except Exception as e:
-            print(f"An unexpected error occurred during CSV export: {e}")
-    else:
-        print("\nNo images were processed, so no metadata CSV was generated.")
+        else:
+            print("\nNo images were processed, so no metadata was written.")
+    except IOError as e:
+        print(f"Error writing CSV file '{OUTPUT_CSV_FILENAME}': {e}")
+    except Exception as e:
+        print(f"An unexpected error occurred during processing: {e}")
 
     # Clean up temporary image files created from Colab uploads
     if is_running_in_colab() and temp_image_paths_colab: